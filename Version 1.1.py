@@ -1,17 +1,398 @@
+import json
+import math
+import os
+import pickle
+import threading
+import time
 import pandas as pd
+import requests
 import yfinance as yf
-from datetime import datetime, timedelta
+from yfinance.exceptions import YFException
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, timedelta
+from functools import lru_cache
 import numpy as np
 
+try:
+    from curl_cffi import CurlError
+except ImportError:  # yfinance releases that still fetch through requests
+    CurlError = requests.RequestException
+
+try:
+    from numba import njit as _njit
+except ImportError:
+    def _njit(*args, **kwargs):
+        """No-op stand-in for numba.njit when numba is not installed"""
+        def decorator(func):
+            return func
+        return decorator
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.undervalued_cache')
+CACHE_TTL = 24 * 60 * 60  # seconds
+
+# Errors raised while fetching one ticker; they skip that ticker instead of aborting the scan
+FETCH_ERRORS = (YFException, CurlError, requests.RequestException, KeyError)
+# Unexpected info values (strings, wrong types) only skip the ticker being extracted
+EXTRACT_ERRORS = FETCH_ERRORS + (TypeError, ValueError)
+
+# Fields read from the yfinance info dict when computing metrics
+INFO_FIELDS = (
+    'longName', 'industry', 'marketCap', 'currentPrice', 'regularMarketPrice',
+    'forwardPE', 'priceToBook', 'profitMargins', 'currentRatio', 'debtToEquity',
+    'trailingEps', 'bookValue', 'dividendYield', 'earningsGrowth',
+    'enterpriseValue', 'ebitda', 'operatingMargins', 'returnOnAssets', 'returnOnEquity'
+)
+
+# Core metrics a ticker must mostly report to be worth scoring
+REQUIRED_FIELDS = ('forwardPE', 'priceToBook', 'profitMargins', 'currentRatio', 'debtToEquity')
+MAX_MISSING_REQUIRED = 3
+
+# Per-ticker metric columns collected before scoring, with their storage dtypes
+METRIC_DTYPES = {
+    'ticker': object,
+    'company': object,
+    'industry': object,
+    'market_cap': np.float64,
+    'pe_ratio': np.float64,
+    'pb_ratio': np.float64,
+    'profit_margin': np.float64,
+    'current_ratio': np.float64,
+    'debt_to_equity': np.float64,
+    'eps': np.float64,
+    'bvps': np.float64,
+    'dividend_yield': np.float64,
+    'earnings_growth': np.float64,
+    'ev_to_ebitda': np.float64,
+    'operating_margin': np.float64,
+    'roa': np.float64,
+    'roe': np.float64,
+    'current_price': np.float64,
+    'distance_from_high': np.float64,
+    'price_to_ma200': np.float64
+}
+
+class FileCache:
+    """
+    On-disk cache for Yahoo Finance responses.
+    
+    Entries are stored under {cache_dir}/{ticker}/{key}.{ext} and expire after ttl seconds.
+    Info dicts are stored as JSON and price history as pickled DataFrames. Expired entries
+    are deleted on write, at most once per ttl. Failed writes are logged and skipped.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, ttl=CACHE_TTL):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self._last_prune = 0
+        self._prune_lock = threading.Lock()
+
+    def _path(self, ticker, key, ext):
+        return os.path.join(self.cache_dir, ticker, f"{key}.{ext}")
+
+    def _is_fresh(self, path):
+        try:
+            return time.time() - os.path.getmtime(path) < self.ttl
+        except OSError:
+            return False
+
+    def _prune(self):
+        """Delete expired entries and leftover temporary files"""
+        cutoff = time.time() - self.ttl
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+    def _write(self, path, mode, dump):
+        # Keys include the date, so expired entries are never read again; clear them out
+        # before writing (other writers wait on the lock until pruning is done)
+        with self._prune_lock:
+            if time.time() - self._last_prune >= self.ttl:
+                self._prune()
+                self._last_prune = time.time()
+        
+        # Write to a temporary file first so concurrent readers never see partial entries
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, mode) as f:
+                dump(f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # Caching is best-effort: a read-only or full disk only means fetching again next time
+            print(f"Could not write cache entry {path}: {str(e)}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def get_json(self, ticker, key):
+        path = self._path(ticker, key, 'json')
+        if not self._is_fresh(path):
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put_json(self, ticker, key, value):
+        self._write(self._path(ticker, key, 'json'), 'w', lambda f: json.dump(value, f, default=str))
+
+    def has_frame(self, ticker, key):
+        return self._is_fresh(self._path(ticker, key, 'pkl'))
+
+    def get_frame(self, ticker, key):
+        path = self._path(ticker, key, 'pkl')
+        if not self._is_fresh(path):
+            return None
+        try:
+            return pd.read_pickle(path)
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def put_frame(self, ticker, key, frame):
+        self._write(self._path(ticker, key, 'pkl'), 'wb', frame.to_pickle)
+
+_file_cache = FileCache()
+
+@lru_cache(maxsize=256)
+def cached_info(ticker, as_of):
+    """Return the yfinance info dict for a ticker as of the given date (YYYY-MM-DD)"""
+    key = f"info_{as_of}"
+    info = _file_cache.get_json(ticker, key)
+    if info is None:
+        info = yf.Ticker(ticker).info
+        _file_cache.put_json(ticker, key, info)
+    return info
+
+def _history_key(start, end):
+    return f"history_{start}_{end}"
+
+def prefetch_histories(tickers, start, end):
+    """Download price history for every ticker not already cached in a single batched request"""
+    key = _history_key(start, end)
+    missing = [t for t in tickers if not _file_cache.has_frame(t, key)]
+    if not missing:
+        return
+    
+    try:
+        data = yf.download(missing, start=start, end=end, group_by='ticker', threads=True,
+                           progress=False, auto_adjust=True)
+    except FETCH_ERRORS as e:
+        # Leave everything uncached; cached_history falls back to per-ticker requests
+        print(f"Batch history download failed: {str(e)}")
+        return
+    
+    if data.empty:
+        return
+    
+    for ticker in missing:
+        if isinstance(data.columns, pd.MultiIndex):
+            if ticker not in data.columns.get_level_values(0):
+                continue
+            hist = data[ticker]
+        else:
+            hist = data
+        # The batched frame aligns dates across tickers, so drop rows this ticker did not trade
+        hist = hist.dropna()
+        # Leave failed downloads uncached so cached_history retries them individually
+        if not hist.empty:
+            _file_cache.put_frame(ticker, key, hist)
+
+@lru_cache(maxsize=256)
+def cached_history(ticker, start, end):
+    """Return daily price history for a ticker between start and end (YYYY-MM-DD, end exclusive)"""
+    key = _history_key(start, end)
+    hist = _file_cache.get_frame(ticker, key)
+    if hist is None:
+        hist = yf.Ticker(ticker).history(start=start, end=end)
+        # history() returns an empty frame on failure; leave it uncached so a later run retries
+        if not hist.empty:
+            _file_cache.put_frame(ticker, key, hist)
+    return hist
+
+@_njit(cache=True)
 def calculate_graham_number(eps, bvps):
     """Calculate Benjamin Graham's number (√(22.5 * EPS * BVPS))"""
-    return np.sqrt(22.5 * eps * bvps) if eps > 0 and bvps > 0 else 0
+    return math.sqrt(22.5 * eps * bvps) if eps > 0 and bvps > 0 else 0.0
 
+@_njit(cache=True)
 def calculate_peg_ratio(pe_ratio, growth_rate):
     """Calculate PEG ratio"""
-    return pe_ratio / growth_rate if growth_rate > 0 else float('inf')
+    return pe_ratio / growth_rate if growth_rate > 0 else math.inf
+
+@_njit(cache=True)
+def graham_vec(eps, bvps, out):
+    """Array version of calculate_graham_number, writing results into out"""
+    for i in range(eps.shape[0]):
+        out[i] = calculate_graham_number(eps[i], bvps[i])
+
+@_njit(cache=True)
+def peg_vec(pe_ratio, growth_rate, out):
+    """Array version of calculate_peg_ratio, writing results into out"""
+    for i in range(pe_ratio.shape[0]):
+        out[i] = calculate_peg_ratio(pe_ratio[i], growth_rate[i])
+
+def _fetch_info(ticker, as_of, min_market_cap):
+    """
+    Fetch the info dict for a single ticker.
+    
+    Returns None if the market cap is below min_market_cap or too few core metrics are reported.
+    """
+    info = cached_info(ticker, as_of)
+    
+    # Skip if market cap is too low
+    if (info.get('marketCap') or 0) < min_market_cap:
+        return None
+    
+    # Skip tickers missing most core metrics; they cannot meet the fundamental criteria sets
+    if sum(info.get(k) is None for k in REQUIRED_FIELDS) > MAX_MISSING_REQUIRED:
+        return None
+    
+    return info
+
+def _extract_metrics(ticker, info, out, i):
+    """
+    Compute the valuation metrics for a single ticker into row i of out.
+    
+    Technical indicators are left as NaN; _technical_indicators fills them in from price
+    history for the tickers where they decide the outcome.
+    """
+    # Read every field we need from the info dict in a single pass
+    vals = {k: info.get(k) for k in INFO_FIELDS}
+    
+    # Get basic financial metrics
+    pe_ratio = vals['forwardPE'] or float('inf')
+    pb_ratio = vals['priceToBook'] or float('inf')
+    profit_margin = vals['profitMargins'] or 0
+    current_ratio = vals['currentRatio'] or 0
+    # A debt-free company legitimately reports 0 here, so only a missing value means infinite
+    debt_to_equity = vals['debtToEquity'] if vals['debtToEquity'] is not None else float('inf')
+    
+    # Additional value metrics
+    eps = vals['trailingEps'] or 0
+    bvps = vals['bookValue'] or 0
+    current_price = vals['currentPrice'] or vals['regularMarketPrice'] or np.nan
+    dividend_yield = (vals['dividendYield'] or 0) * 100
+    earnings_growth = (vals['earningsGrowth'] or 0) * 100
+    ebitda = vals['ebitda']
+    ev_to_ebitda = (vals['enterpriseValue'] or 0) / ebitda if ebitda else float('inf')
+    operating_margin = (vals['operatingMargins'] or 0) * 100
+    roa = (vals['returnOnAssets'] or 0) * 100
+    roe = (vals['returnOnEquity'] or 0) * 100
+
+    out['ticker'][i] = ticker
+    out['company'][i] = vals['longName'] or 'N/A'
+    out['industry'][i] = vals['industry'] or 'N/A'
+    out['market_cap'][i] = vals['marketCap'] or 0
+    out['pe_ratio'][i] = pe_ratio
+    out['pb_ratio'][i] = pb_ratio
+    out['profit_margin'][i] = profit_margin
+    out['current_ratio'][i] = current_ratio
+    out['debt_to_equity'][i] = debt_to_equity
+    out['eps'][i] = eps
+    out['bvps'][i] = bvps
+    out['dividend_yield'][i] = dividend_yield
+    out['earnings_growth'][i] = earnings_growth
+    out['ev_to_ebitda'][i] = ev_to_ebitda
+    out['operating_margin'][i] = operating_margin
+    out['roa'][i] = roa
+    out['roe'][i] = roe
+    out['current_price'][i] = current_price
+    out['distance_from_high'][i] = np.nan
+    out['price_to_ma200'][i] = np.nan
+
+def _technical_indicators(hist, current_price):
+    """
+    Compute the technical indicators for a single ticker from its price history.
+    
+    current_price is the price used for the rest of the row; the latest close is only used
+    when it is missing, so every column in a row is based on the same price.
+    
+    Returns the distance from the 52-week high and the price relative to the 200-day MA
+    (both in percent), and the price they were computed against.
+    """
+    # Drop missing closes so the latest price and the 200-day mean only see real sessions
+    close = hist['Close'].dropna()
+    if close.empty:
+        return np.nan, np.nan, current_price
+    
+    # float32 is plenty for these reductions and halves the memory they touch
+    highs = hist['High'].to_numpy(dtype=np.float32)
+    closes = close.to_numpy(dtype=np.float32)
+    
+    fifty_two_week_high = float(np.nanmax(highs))
+    if np.isnan(current_price):
+        current_price = float(close.iloc[-1])
+    distance_from_high = ((fifty_two_week_high - current_price) / fifty_two_week_high) * 100
+    
+    # Calculate 200-day moving average (only the latest value is needed, so skip the rolling window)
+    ma200 = float(closes[-200:].mean()) if len(closes) >= 200 else np.nan
+    if not np.isnan(ma200):
+        price_to_ma200 = (current_price / ma200 - 1) * 100
+    else:
+        price_to_ma200 = 0
+    
+    return distance_from_high, price_to_ma200, current_price
+
+def _apply_kernel(kernel, *columns):
+    """Run an array kernel over float64 copies of the given columns and return its output"""
+    arrays = [col.to_numpy(dtype=np.float64) for col in columns]
+    out = np.empty(len(arrays[0]), dtype=np.float64)
+    kernel(*arrays, out)
+    return out
+
+def _technical_criteria(metrics, thresholds):
+    """Evaluate the Technical Factors criteria set across all tickers"""
+    return (
+        (metrics['distance_from_high'] > thresholds['min_distance_from_high']) &
+        (metrics['price_to_ma200'] < thresholds['max_price_to_ma200'])
+    )
 
-def analyze_stocks(tickers, min_market_cap=1000000000, criteria_threshold=3, custom_thresholds=None):
+def _evaluate_criteria(metrics, thresholds):
+    """
+    Evaluate every criteria set across all tickers at once.
+    
+    Returns the criteria set names and a boolean matrix with one row per ticker
+    and one column per criteria set.
+    """
+    # Enhanced screening criteria for undervalued stocks
+    value_criteria = {
+        'Traditional Value': (
+            (metrics['pe_ratio'] < thresholds['max_pe']) &
+            (metrics['pb_ratio'] < thresholds['max_pb']) &
+            (metrics['profit_margin'] > thresholds['min_profit_margin'])
+        ),
+        'Quality Metrics': (
+            (metrics['current_ratio'] > thresholds['min_current_ratio']) &
+            (metrics['debt_to_equity'] < thresholds['max_debt_equity']) &
+            (metrics['operating_margin'] > thresholds['min_operating_margin'])
+        ),
+        'Growth at Reasonable Price': (
+            (metrics['peg_ratio'] < thresholds['max_peg']) &
+            (metrics['earnings_growth'] > thresholds['min_earnings_growth'])
+        ),
+        'Graham Style': (
+            (metrics['graham_number'] > metrics['current_price']) &
+            (metrics['dividend_yield'] > thresholds['min_div_yield'])
+        ),
+        'Profitability': (
+            (metrics['roa'] > thresholds['min_roa']) &
+            (metrics['roe'] > thresholds['min_roe'])
+        ),
+        # Kept last so callers can score the fundamental sets separately
+        'Technical Factors': _technical_criteria(metrics, thresholds)
+    }
+    
+    criteria_matrix = np.column_stack([mask.to_numpy(dtype=bool) for mask in value_criteria.values()])
+    return list(value_criteria), criteria_matrix
+
+def analyze_stocks(tickers, min_market_cap=1000000000, criteria_threshold=3, custom_thresholds=None, max_workers=8):
     """
     Analyze stocks to find potentially undervalued candidates based on various metrics.
     
@@ -20,9 +401,13 @@ def analyze_stocks(tickers, min_market_cap=1000000000, criteria_threshold=3, cus
     min_market_cap (float): Minimum market cap in dollars/local currency to consider
     criteria_threshold (int): Minimum number of criteria sets that must be met
     custom_thresholds (dict): User-defined thresholds for valuation metrics
+    max_workers (int): Number of ticker info requests made concurrently
     
     Returns:
-    pandas.DataFrame: Analysis results for potentially undervalued stocks
+    pandas.DataFrame: Analysis results for potentially undervalued stocks. Price history is
+    only downloaded for tickers that fall short of criteria_threshold on fundamentals but
+    could still reach it with the history-based criteria; for all other tickers the
+    technical columns are NaN and Technical Factors is not counted.
     """
     # Default thresholds
     thresholds = {
@@ -44,181 +429,202 @@ def analyze_stocks(tickers, min_market_cap=1000000000, criteria_threshold=3, cus
     if custom_thresholds:
         thresholds.update(custom_thresholds)
 
-    results = []
-    
-    for ticker in tickers:
-        try:
-            # Get stock data
-            stock = yf.Ticker(ticker)
-            info = stock.info
-            
-            # Skip if market cap is too low
-            if info.get('marketCap', 0) < min_market_cap:
-                continue
-                
-            # Get basic financial metrics
-            pe_ratio = info.get('forwardPE', float('inf'))
-            pb_ratio = info.get('priceToBook', float('inf'))
-            profit_margin = info.get('profitMargins', 0)
-            current_ratio = info.get('currentRatio', 0)
-            debt_to_equity = info.get('debtToEquity', float('inf'))
-            
-            # Additional value metrics
-            eps = info.get('trailingEps', 0)
-            bvps = info.get('bookValue', 0)
-            graham_number = calculate_graham_number(eps, bvps)
-            current_price = info.get('currentPrice', 0)
-            dividend_yield = info.get('dividendYield', 0) * 100 if info.get('dividendYield') else 0
-            earnings_growth = info.get('earningsGrowth', 0) * 100 if info.get('earningsGrowth') else 0
-            peg_ratio = calculate_peg_ratio(pe_ratio, earnings_growth)
-            enterprise_value = info.get('enterpriseValue', 0)
-            ebitda = info.get('ebitda', 0)
-            ev_to_ebitda = enterprise_value / ebitda if ebitda else float('inf')
-            operating_margin = info.get('operatingMargins', 0) * 100
-            roa = info.get('returnOnAssets', 0) * 100 if info.get('returnOnAssets') else 0
-            roe = info.get('returnOnEquity', 0) * 100 if info.get('returnOnEquity') else 0
-            
-            # Get historical price data for technical analysis
-            end_date = datetime.now()
-            start_date = end_date - timedelta(days=365)
-            hist = stock.history(start=start_date, end=end_date)
-            
-            if hist.empty:
-                continue
+    # Resolve the scan date once so every request and cache key shares the same boundaries
+    today = date.today()
+    as_of = today.isoformat()
+    # The end date is exclusive, so push it to tomorrow to include today's session
+    start = (today - timedelta(days=365)).isoformat()
+    end = (today + timedelta(days=1)).isoformat()
 
-            # Calculate technical indicators
-            fifty_two_week_high = hist['High'].max()
-            fifty_two_week_low = hist['Low'].min()
-            current_price = hist['Close'][-1]
-            distance_from_high = ((fifty_two_week_high - current_price) / fifty_two_week_high) * 100
-            
-            # Calculate 200-day moving average
-            ma200_series = hist['Close'].rolling(window=200).mean()
-            if len(ma200_series) > 0 and not np.isnan(ma200_series.iloc[-1]):
-                ma200 = ma200_series.iloc[-1]
-                price_to_ma200 = (current_price / ma200 - 1) * 100
-            else:
-                price_to_ma200 = 0
-
-            # Enhanced screening criteria for undervalued stocks
-            value_criteria = {
-                'Traditional Value': (
-                    pe_ratio < thresholds['max_pe'] and
-                    pb_ratio < thresholds['max_pb'] and
-                    profit_margin > thresholds['min_profit_margin']
-                ),
-                'Quality Metrics': (
-                    current_ratio > thresholds['min_current_ratio'] and
-                    debt_to_equity < thresholds['max_debt_equity'] and
-                    operating_margin > thresholds['min_operating_margin']
-                ),
-                'Growth at Reasonable Price': (
-                    peg_ratio < thresholds['max_peg'] and
-                    earnings_growth > thresholds['min_earnings_growth']
-                ),
-                'Graham Style': (
-                    graham_number > current_price and
-                    dividend_yield > thresholds['min_div_yield']
-                ),
-                'Profitability': (
-                    roa > thresholds['min_roa'] and
-                    roe > thresholds['min_roe']
-                ),
-                'Technical Factors': (
-                    distance_from_high > thresholds['min_distance_from_high'] and
-                    price_to_ma200 < thresholds['max_price_to_ma200']
-                )
-            }
-            
-            # Count how many criteria sets are met
-            criteria_met = sum(value_criteria.values())
+    # Yahoo has no batch endpoint for info, so fan those requests out across threads
+    infos = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_fetch_info, ticker, as_of, min_market_cap): ticker for ticker in tickers}
+        
+        for future in as_completed(futures):
+            ticker = futures[future]
+            try:
+                info = future.result()
+            except FETCH_ERRORS as e:
+                print(f"Error analyzing {ticker}: {str(e)}")
+                continue
             
-            # Consider stock undervalued if it meets the user-defined threshold
-            if criteria_met >= criteria_threshold:
-                results.append({
-                    'Ticker': ticker,
-                    'Company': info.get('longName', 'N/A'),
-                    'Market Cap (B)': round(info.get('marketCap', 0) / 1e9, 2),
-                    'Criteria Met': criteria_met,
-                    # Valuation metrics
-                    'P/E Ratio': round(pe_ratio, 2),
-                    'P/B Ratio': round(pb_ratio, 2),
-                    'EV/EBITDA': round(ev_to_ebitda, 2),
-                    'PEG Ratio': round(peg_ratio, 2),
-                    # Growth & Income
-                    'Earnings Growth (%)': round(earnings_growth, 2),
-                    'Dividend Yield (%)': round(dividend_yield, 2),
-                    # Profitability metrics
-                    'Operating Margin (%)': round(operating_margin, 2),
-                    'ROE (%)': round(roe, 2),
-                    'ROA (%)': round(roa, 2),
-                    # Financial health
-                    'Current Ratio': round(current_ratio, 2),
-                    'Debt/Equity': round(debt_to_equity, 2),
-                    # Technical indicators
-                    'Distance from 52w High (%)': round(distance_from_high, 2),
-                    'Price to 200MA (%)': round(price_to_ma200, 2),
-                    # Additional info
-                    'Graham Number': round(graham_number, 2),
-                    'Current Price': round(current_price, 2),
-                    'Industry': info.get('industry', 'N/A'),
-                    # Store which criteria were met for recommendations
-                    'Met Criteria': {k: v for k, v in value_criteria.items() if v}
-                })
-                
-        except Exception as e:
+            if info is not None:
+                infos[ticker] = info
+    
+    if not infos:
+        return pd.DataFrame()
+    
+    # Pre-allocate typed metric columns and fill them row by row
+    out = {col: np.empty(len(infos), dtype=dtype) for col, dtype in METRIC_DTYPES.items()}
+    n_filled = 0
+    
+    for ticker, info in infos.items():
+        try:
+            _extract_metrics(ticker, info, out, n_filled)
+        except EXTRACT_ERRORS as e:
             print(f"Error analyzing {ticker}: {str(e)}")
             continue
+        n_filled += 1
     
-    # Create DataFrame and sort by number of criteria met, then market cap
-    df = pd.DataFrame(results)
-    if not df.empty:
-        df = df.sort_values(['Criteria Met', 'Market Cap (B)'], ascending=[False, False])
+    if not n_filled:
+        return pd.DataFrame()
     
-    return df
-
-def get_stock_recommendations(df, top_n=5):
-    """
-    Generate detailed recommendations for the top undervalued stocks.
-    """
-    recommendations = {}
+    # Score all tickers in one pass and keep those meeting the user-defined threshold
+    metrics = pd.DataFrame({col: values[:n_filled] for col, values in out.items()})
+    metrics['graham_number'] = _apply_kernel(graham_vec, metrics['eps'], metrics['bvps'])
+    metrics['peg_ratio'] = _apply_kernel(peg_vec, metrics['pe_ratio'], metrics['earnings_growth'])
+    criteria_names, criteria_matrix = _evaluate_criteria(metrics, thresholds)
     
-    for _, row in df.head(top_n).iterrows():
-        met_criteria = row['Met Criteria']
+    # Price history only matters where it can decide the outcome. It always adds Technical
+    # Factors, and for tickers whose info has no price, the last close can also make Graham
+    # Style pass if its dividend half already does. Tickers that already pass on fundamentals,
+    # or cannot reach the threshold even then, are not downloaded and keep NaN technical
+    # columns (so Technical Factors is not counted for them)
+    fundamental_met = criteria_matrix[:, :-1].sum(axis=1)
+    graham_pending = (
+        metrics['current_price'].isna() &
+        (metrics['graham_number'] > 0) &
+        (metrics['dividend_yield'] > thresholds['min_div_yield'])
+    ).to_numpy(dtype=int)
+    reachable = fundamental_met + 1 + graham_pending
+    needs_history = np.flatnonzero((fundamental_met < criteria_threshold) & (reachable >= criteria_threshold))
+    
+    if len(needs_history):
+        # Price history for those tickers comes from one batched download
+        prefetch_histories(metrics['ticker'].iloc[needs_history].tolist(), start, end)
         
-        analysis = {
-            'Company': row['Company'],
-            'Analysis': f"""
+        for i in needs_history:
+            ticker = metrics.at[i, 'ticker']
+            try:
+                hist = cached_history(ticker, start, end)
+                if not hist.empty:
+                    metrics.loc[i, ['distance_from_high', 'price_to_ma200', 'current_price']] = (
+                        _technical_indicators(hist, metrics.at[i, 'current_price'])
+                    )
+            except EXTRACT_ERRORS as e:
+                print(f"Error analyzing {ticker}: {str(e)}")
+        
+        # Re-score every set, since a price filled in from history also feeds Graham Style
+        criteria_names, criteria_matrix = _evaluate_criteria(metrics, thresholds)
+    
+    criteria_met = criteria_matrix.sum(axis=1)
+    # Resolve the filter and the sort into a single row order before materializing any output,
+    # so only passing rows are gathered once. Sort by number of criteria met, then market cap
+    # (rounded, as displayed), both descending; the last lexsort key is the primary one.
+    passed = np.flatnonzero(criteria_met >= criteria_threshold)
+    market_cap_b = np.round(metrics['market_cap'].to_numpy()[passed] / 1e9, 2)
+    order = passed[np.lexsort((-market_cap_b, -criteria_met[passed]))]
+    selected = metrics.iloc[order].reset_index(drop=True)
+    
+    df = pd.DataFrame({
+        'Ticker': selected['ticker'],
+        'Company': selected['company'],
+        'Market Cap (B)': selected['market_cap'] / 1e9,
+        'Criteria Met': criteria_met[order],
+        # Valuation metrics
+        'P/E Ratio': selected['pe_ratio'],
+        'P/B Ratio': selected['pb_ratio'],
+        'EV/EBITDA': selected['ev_to_ebitda'],
+        'PEG Ratio': selected['peg_ratio'],
+        # Growth & Income
+        'Earnings Growth (%)': selected['earnings_growth'],
+        'Dividend Yield (%)': selected['dividend_yield'],
+        # Profitability metrics
+        'Operating Margin (%)': selected['operating_margin'],
+        'ROE (%)': selected['roe'],
+        'ROA (%)': selected['roa'],
+        # Financial health
+        'Current Ratio': selected['current_ratio'],
+        'Debt/Equity': selected['debt_to_equity'],
+        # Technical indicators
+        'Distance from 52w High (%)': selected['distance_from_high'],
+        'Price to 200MA (%)': selected['price_to_ma200'],
+        # Additional info
+        'Graham Number': selected['graham_number'],
+        'Current Price': selected['current_price'],
+        'Industry': selected['industry'],
+        # Store which criteria were met for recommendations
+        'Met Criteria': [
+            {name: True for name, met in zip(criteria_names, row) if met}
+            for row in criteria_matrix[order]
+        ]
+    })
+    
+    # Round all numeric columns in one vectorized pass; text and dict columns are left as-is
+    df = df.round(2)
+    
+    return df
+
+# Investment thesis text, filled per ticker by get_stock_recommendations
+RECOMMENDATION_TEMPLATE = """
                 Investment Thesis:
-                {row['Company']} shows strong value characteristics across {len(met_criteria)} major criteria:
-                {', '.join(met_criteria.keys())}
+                {company} shows strong value characteristics across {criteria_count} major criteria:
+                {criteria_list}
                 
                 Key Strengths:
-                - {'P/E ratio of ' + str(row['P/E Ratio']) if row['P/E Ratio'] != float('inf') else 'N/A'}
-                - {'Earnings growth of ' + str(row['Earnings Growth (%)']) + '%' if row['Earnings Growth (%)'] > 0 else 'N/A'}
-                - {'Dividend yield of ' + str(row['Dividend Yield (%)']) + '%' if row['Dividend Yield (%)'] > 0 else 'N/A'}
-                - {'ROE of ' + str(row['ROE (%)']) + '%' if row['ROE (%)'] > 0 else 'N/A'}
+                - {pe_strength}
+                - {growth_strength}
+                - {dividend_strength}
+                - {roe_strength}
                 
                 Valuation Metrics:
-                - EV/EBITDA: {row['EV/EBITDA']}
-                - PEG Ratio: {row['PEG Ratio']}
-                - Trading at {row['Distance from 52w High (%)']}% below 52-week high
-                - Price is {abs(row['Price to 200MA (%)']):,.1f}% {'below' if row['Price to 200MA (%)'] < 0 else 'above'} 200-day moving average
+                - EV/EBITDA: {ev_to_ebitda}
+                - PEG Ratio: {peg_ratio}
+                - {high_line}
+                - {ma200_line}
                 
                 Financial Health:
-                - Operating Margin: {row['Operating Margin (%)']}%
-                - Current Ratio: {row['Current Ratio']}
-                - Debt/Equity: {row['Debt/Equity']}
+                - Operating Margin: {operating_margin}%
+                - Current Ratio: {current_ratio}
+                - Debt/Equity: {debt_to_equity}
                 
                 Risk Factors:
-                - Industry: {row['Industry']}
-                - Market Cap: ${row['Market Cap (B)']}B
+                - Industry: {industry}
+                - Market Cap: ${market_cap}B
                 
                 Recommendation: 
                 The stock meets multiple value criteria suggesting a potential margin of safety.
             """
+
+def get_stock_recommendations(df, top_n=5):
+    """
+    Generate detailed recommendations for the top undervalued stocks.
+    """
+    recommendations = {}
+    
+    for _, row in df.head(top_n).iterrows():
+        r = row.to_dict()
+        met_criteria = r['Met Criteria']
+        
+        recommendations[r['Ticker']] = {
+            'Company': r['Company'],
+            'Analysis': RECOMMENDATION_TEMPLATE.format_map({
+                'company': r['Company'],
+                'criteria_count': len(met_criteria),
+                'criteria_list': ', '.join(met_criteria.keys()),
+                'pe_strength': f"P/E ratio of {r['P/E Ratio']}" if r['P/E Ratio'] != float('inf') else 'N/A',
+                'growth_strength': f"Earnings growth of {r['Earnings Growth (%)']}%" if r['Earnings Growth (%)'] > 0 else 'N/A',
+                'dividend_strength': f"Dividend yield of {r['Dividend Yield (%)']}%" if r['Dividend Yield (%)'] > 0 else 'N/A',
+                'roe_strength': f"ROE of {r['ROE (%)']}%" if r['ROE (%)'] > 0 else 'N/A',
+                'ev_to_ebitda': r['EV/EBITDA'],
+                'peg_ratio': r['PEG Ratio'],
+                'high_line': (
+                    f"Trading at {r['Distance from 52w High (%)']}% below 52-week high"
+                    if not pd.isna(r['Distance from 52w High (%)']) else "52-week high: N/A (price history not downloaded)"
+                ),
+                'ma200_line': (
+                    f"Price is {abs(r['Price to 200MA (%)']):,.1f}% "
+                    f"{'below' if r['Price to 200MA (%)'] < 0 else 'above'} 200-day moving average"
+                    if not pd.isna(r['Price to 200MA (%)']) else "200-day moving average: N/A (price history not downloaded)"
+                ),
+                'operating_margin': r['Operating Margin (%)'],
+                'current_ratio': r['Current Ratio'],
+                'debt_to_equity': r['Debt/Equity'],
+                'industry': r['Industry'],
+                'market_cap': r['Market Cap (B)']
+            })
         }
-        recommendations[row['Ticker']] = analysis
     
     return recommendations
 
@@ -300,6 +706,9 @@ def main():
     if not results.empty:
         print("\nPotentially Undervalued Stocks:")
         print(results.to_string(index=False))
+        if results['Distance from 52w High (%)'].isna().any():
+            print("\nNote: technical columns show NaN where price history was not downloaded "
+                  "because it could not change the result; Technical Factors is not counted for those stocks.")
         
         # Get detailed recommendations
         recommendations = get_stock_recommendations(results)